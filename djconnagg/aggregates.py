@@ -1,10 +1,297 @@
+import copy
+import datetime
+import re
+from decimal import Decimal
+from functools import partial
+from itertools import chain
+from operator import add
+
 import django
 from django.db.models import Aggregate, Q
 from django.db.models.sql.aggregates import Aggregate as SQLAggregate
+from django.db.models.sql.where import Constraint
+from django.utils import six
+from django.utils.tree import Node
 
 
 DJANGO_MAJOR, DJANGO_MINOR, _, _, _ = django.VERSION
 
+if DJANGO_MAJOR == 1 and DJANGO_MINOR == 7:
+    def _unwrap_child(child):
+        # transformed Q children are (WhereNode, joins_used) tuples
+        return child[0]
+
+    def _qn_adjust(qn):
+        # in Django 1.7 WhereNode.as_sql expects `qn` to have a `compile`
+        # method (i.e not really expecting a quote names function any more
+        # they are expecting a django.db.models.sql.compiler.SQLCompiler)
+        return getattr(qn, '__self__', qn)
+else:
+    def _unwrap_child(child):
+        # transformed Q children are WhereNodes
+        return child
+
+    def _qn_adjust(qn):
+        return qn
+
+# rendered WHEN clauses, keyed by (q cache key, connection vendor)
+_RENDER_CACHE_SIZE = 512
+_render_cache = {}
+
+_JOINSTR = {
+    Q.AND: u' AND ',
+    Q.OR: u' OR ',
+}
+
+_SQL_TEMPLATE = (
+    '%(function)s('
+    'CASE WHEN %(when_clause)s THEN %(value)s ELSE %(default)s END'
+    ')'
+)
+
+# SQL templates split into the literal pieces around their placeholders
+_TEMPLATE_KEYS = ('function', 'when_clause', 'value', 'default')
+_TEMPLATE_PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+_template_parts = {}
+
+# WhereNodes returned by Query.build_filter, keyed by
+# (model, lookup, repr(value), alias map key)
+_FILTER_CACHE_SIZE = 512
+_filter_cache = {}
+
+_CONSTANT_TYPES = (six.binary_type, six.text_type) + six.integer_types + (
+    float,
+    bool,
+    Decimal,
+    datetime.date,
+    datetime.datetime,
+    datetime.time,
+    datetime.timedelta,
+    type(None),
+)
+_COLLECTION_TYPES = (list, tuple, set, frozenset)
+
+# exact types of the above, for a quick lookup before the isinstance checks
+_CONSTANT_TYPES_SET = frozenset(_CONSTANT_TYPES)
+
+
+def _is_constant(value):
+    """
+    True if `value` is a plain literal (or collection of literals) whose
+    `repr` is stable, i.e. not an expression, queryset or other object which
+    could render differently from one query to the next.
+    """
+    value_type = type(value)
+    if value_type in _CONSTANT_TYPES_SET:
+        return True
+    if isinstance(value, _COLLECTION_TYPES):
+        return all(_is_constant(v) for v in value)
+    return isinstance(value, _CONSTANT_TYPES)
+
+
+def _leaf_key(leaf):
+    """
+    Returns a hashable key for a single WhereNode child, or None if it
+    can't be safely cached.
+    """
+    if isinstance(leaf, Q):
+        return _q_cache_key(leaf)
+    if isinstance(leaf, Node):
+        # WhereNode
+        return _node_key(leaf, leaf.children)
+    if isinstance(leaf, tuple):
+        # Django 1.6 (and 1.7 legacy lookups) store leaves as:
+        # (Constraint, lookup_type, value_annotation, value)
+        constraint, lookup_type, value_annotation, value = leaf
+        if not isinstance(constraint, Constraint) or not _is_constant(value):
+            return None
+        return (
+            constraint.alias,
+            constraint.col,
+            lookup_type,
+            repr(value_annotation),
+            repr(value),
+        )
+    # Django 1.7 Lookup objects
+    lhs = getattr(leaf, 'lhs', None)
+    if lhs is None or not hasattr(lhs, 'target') or not _is_constant(leaf.rhs):
+        return None
+    return (lhs.alias, lhs.target.column, leaf.lookup_name, repr(leaf.rhs))
+
+
+def _node_key(node, children):
+    keys = []
+    for child in children:
+        key = _leaf_key(child)
+        if key is None:
+            return None
+        keys.append(key)
+    return (node.connector, node.negated, tuple(keys))
+
+
+def _q_cache_key(q):
+    """
+    Returns a hashable canonical form of a transformed Q tree (see
+    transform_q), or None if any part of it can't be safely cached.
+
+    Two trees with the same key render to the same SQL and params on the
+    same db backend.
+    """
+    return _node_key(q, [
+        child if isinstance(child, Q) else _unwrap_child(child)
+        for child in q.children
+    ])
+
+
+def _when_key(q):
+    """
+    Returns a hashable canonical form of an untransformed Q tree, or None if
+    any of its values aren't plain literals (e.g. callables, which Django
+    evaluates afresh each time a filter is built).
+
+    Values are captured by `repr`, so mutating a list in the tree changes
+    the key.
+    """
+    keys = []
+    for child in q.children:
+        if isinstance(child, Q):
+            key = _when_key(child)
+        else:
+            lookup, value = child
+            key = (lookup, repr(value)) if _is_constant(value) else None
+        if key is None:
+            return None
+        keys.append(key)
+    return (q.connector, q.negated, tuple(keys))
+
+
+def _split_template(template):
+    """
+    Splits an SQLConditionalAggregate.sql_template into the literal pieces
+    around its placeholders, so it can be filled by plain concatenation.
+
+    Returns None for templates which don't use exactly our placeholders, in
+    the usual order, or which contain any other `%` sequence. Those have to
+    be filled via `%` interpolation instead.
+    """
+    try:
+        return _template_parts[template]
+    except KeyError:
+        pass
+    pieces = _TEMPLATE_PLACEHOLDER.split(template)
+    literals = tuple(pieces[::2])
+    if (tuple(pieces[1::2]) != _TEMPLATE_KEYS or
+            any('%' in literal for literal in literals)):
+        literals = None
+    _template_parts[template] = literals
+    return literals
+
+
+def _alias_map_key(query):
+    """
+    Returns a hashable summary of the joins currently set up on `query`.
+
+    The whole JoinInfo is needed, the same table can be joined via
+    different foreign keys (`join_cols`, `join_field`).
+    """
+    return frozenset(six.iteritems(query.alias_map))
+
+
+def _clone_filter(node):
+    """
+    Shallow copy of a Query.build_filter result (Django 1.7 returns a
+    (WhereNode, joins_used) tuple, Django 1.6 just the WhereNode).
+    """
+    if isinstance(node, tuple):
+        where_node, joins_used = node
+        return copy.copy(where_node), joins_used
+    return copy.copy(node)
+
+
+def _snapshot_joins(query):
+    return dict(query.alias_map), dict(query.alias_refcount)
+
+
+def _join_refs(query, joins):
+    """
+    Compares the joins on `query` with an earlier `_snapshot_joins(query)`.
+
+    :returns: tuple of (alias, refcount change) pairs, or None if any joins
+        were added or changed in the meantime
+    """
+    alias_map, refcount = joins
+    joins_changed = (
+        len(alias_map) != len(query.alias_map) or
+        any(query.alias_map.get(alias) is not join
+            for alias, join in six.iteritems(alias_map))
+    )
+    if joins_changed:
+        return None
+    return tuple(
+        (alias, query.alias_refcount[alias] - count)
+        for alias, count in six.iteritems(refcount)
+        if query.alias_refcount[alias] != count
+    )
+
+
+def _build_filter(query, filter_expr, alias_key=None):
+    """
+    Equivalent to `query.build_filter(filter_expr)` but re-uses the result of
+    an earlier call for the same model, filter and joins.
+
+    Only filters on literal values which didn't need to add or promote any
+    joins are cached. On a cache hit we replay the alias refcount changes
+    build_filter would have made, as Django relies on those to decide which
+    joins end up in the query.
+
+    :param alias_key: `_alias_map_key(query)` if the caller already has it
+
+    :returns: (build_filter result, alias key) tuple, where the alias key
+        is still valid for `query` afterwards, or None if it may not be
+    """
+    lookup, value = filter_expr
+    if not _is_constant(value):
+        return query.build_filter(filter_expr), None
+
+    if alias_key is None:
+        alias_key = _alias_map_key(query)
+    key = (query.model, lookup, repr(value), alias_key)
+    try:
+        node, refs = _filter_cache[key]
+    except KeyError:
+        pass
+    else:
+        for alias, count in refs:
+            query.alias_refcount[alias] += count
+        return _clone_filter(node), alias_key
+
+    joins = _snapshot_joins(query)
+    node = query.build_filter(filter_expr)
+    refs = _join_refs(query, joins)
+    if refs is None:
+        return node, None
+
+    if len(_filter_cache) >= _FILTER_CACHE_SIZE:
+        _filter_cache.clear()
+    _filter_cache[key] = (_clone_filter(node), refs)
+    return node, alias_key
+
+
+def _shallow_clone_q(q):
+    """
+    Copies the structure of a Q tree, sharing its (lookup, value) leaves.
+
+    transform_q only ever replaces items in the `children` lists, so these
+    are all we need to copy to leave the original untouched.
+    """
+    clone = q.__class__._new_instance(connector=q.connector,
+                                      negated=q.negated)
+    clone.children = [
+        _shallow_clone_q(child) if isinstance(child, Q) else child
+        for child in q.children
+    ]
+    return clone
+
 
 def transform_q(q, query):
     """
@@ -17,13 +304,152 @@ def transform_q(q, query):
     from ConditionalAggregate down into SQLConditionalAggregate, which Django
     avoids to do in their API so we try and follow their lead here)
     """
-    for i, child in enumerate(q.children):
-        if isinstance(child, Q):
-            transform_q(child, query)
-        else:
-            # child is (lookup, value) tuple
-            where_node = query.build_filter(child)
-            q.children[i] = where_node
+    _isinstance = isinstance
+    _Q = Q
+    build_filter = _build_filter
+    # the joins only change when build_filter has to add one, so this can
+    # usually be carried over from one leaf to the next
+    alias_key = None
+
+    # Walk the tree iteratively, depth-first and in order (so any joins get
+    # set up, and aliased, in the same order as Django would for a filter)
+    # each frame is: (children, index of next child)
+    stack = [(q.children, 0)]
+    while stack:
+        children, i = stack.pop()
+        while i < len(children):
+            child = children[i]
+            i += 1
+            if _isinstance(child, _Q):
+                stack.append((children, i))
+                children, i = child.children, 0
+            else:
+                # child is (lookup, value) tuple
+                children[i - 1], alias_key = build_filter(
+                    query, child, alias_key
+                )
+
+
+def _skip_single(q):
+    """
+    Follows a chain of non-negated, single-child Q nodes down to the first
+    node worth rendering (a leaf, or a Q with several or no children).
+
+    Wrapping a lone child in parentheses doesn't change its meaning.
+    """
+    while isinstance(q, Q) and len(q.children) == 1 and not q.negated:
+        q = q.children[0]
+    return q
+
+
+def _cached_leaf_sql(leaf, qn, connection):
+    """
+    Equivalent to `leaf.as_sql(qn, connection)` but re-uses an earlier
+    rendering of the same leaf on the same db backend.
+
+    Only for leaves on literal values (see _leaf_key), the params are
+    returned as a tuple so that callers can't modify the cached copy.
+    """
+    cache = leaf.__dict__.setdefault('_sql_cache', {})
+    try:
+        return cache[connection.vendor]
+    except KeyError:
+        sql, params = leaf.as_sql(qn, connection)
+        cache[connection.vendor] = sql, tuple(params)
+        return sql, params
+
+
+def compile_q(q):
+    """
+    Compiles the Q object into a function which renders it into SQL for the
+    WHEN clause.
+
+    The tree is walked just once, up front, flattening it into the literal
+    SQL between its leaves (parentheses, connectors, negations). Rendering
+    is then just a matter of calling `as_sql` on each leaf in turn.
+
+    :param q: Q object representing the filter condition, after transform_q
+
+    :returns: `render_into(qn, connection, out, params)` function, which
+        appends the SQL fragments to the `out` list and the query params to
+        the `params` list (see render_q for the other args)
+    """
+    # literals[i] goes before leaves[i], with literals[-1] last of all
+    # (leaves are the WhereNodes from transform_q)
+    literals = []
+    leaves = []
+
+    q = _skip_single(q)
+    if not isinstance(q, Q):
+        literals.append(u'')
+        leaves.append(_unwrap_child(q))
+        literals.append(u'')
+    elif not q.children and not q.negated:
+        literals.append(u'')
+    else:
+        # walk the tree iteratively, collecting literal fragments into a
+        # buffer until we reach the next leaf
+        _isinstance = isinstance
+        _Q = Q
+        skip_single = _skip_single
+        unwrap_child = _unwrap_child
+        joinstrs = _JOINSTR
+        literals_append = literals.append
+        leaves_append = leaves.append
+        buf = []
+        buf_append = buf.append
+        join = u''.join
+
+        buf_append(u'NOT (' if q.negated else u'(')
+        # each frame is: [children, index of next child, joinstr, closing]
+        stack = [[q.children, 0, joinstrs[q.connector], u')']]
+        stack_append = stack.append
+        while stack:
+            frame = stack[-1]
+            children, i, joinstr, closing = frame
+            if i == len(children):
+                buf_append(closing)
+                stack.pop()
+                continue
+            frame[1] = i + 1
+            if i:
+                buf_append(joinstr)
+
+            child = skip_single(children[i])
+            if _isinstance(child, _Q):
+                # nested Q gets wrapped in an extra set of parentheses
+                buf_append(u'(NOT (' if child.negated else u'((')
+                stack_append(
+                    [child.children, 0, joinstrs[child.connector], u'))']
+                )
+            else:
+                literals_append(join(buf))
+                leaves_append(unwrap_child(child))
+                del buf[:]
+        literals_append(join(buf))
+
+    first_literal = literals[0]
+    # literals[i + 1] follows the leaf rendered by leaf_sqls[i]
+    other_literals = literals[1:]
+    leaf_sqls = [
+        partial(_cached_leaf_sql, leaf)
+        if _leaf_key(leaf) is not None else leaf.as_sql
+        for leaf in leaves
+    ]
+
+    def render_into(qn, connection, out, params):
+        out.append(first_literal)
+        if not leaf_sqls:
+            return
+        qn = _qn_adjust(qn)
+        conditions, param_parts = zip(
+            *[leaf_sql(qn, connection) for leaf_sql in leaf_sqls]
+        )
+        out.extend(map(add, conditions, other_literals))
+        # flatten the params of all the leaves in one go
+        params.extend(chain.from_iterable(param_parts))
+
+    return render_into
 
 
 def render_q(q, qn, connection):
@@ -41,40 +467,10 @@ def render_q(q, qn, connection):
 
     :returns:  (SQL template str, params list) tuple
     """
-    joinstr = u' {} '.format(q.connector)
-    conditions = []
+    out = []
     params = []
-
-    if DJANGO_MAJOR == 1 and DJANGO_MINOR == 7:
-        # in Django 1.7 WhereNode.as_sql expects `qn` to have a `compile`
-        # method (i.e not really expecting a quote names function any more
-        # they are expecting a django.db.models.sql.compiler.SQLCompiler)
-        try:
-            qn = qn.__self__
-        except AttributeError:
-            pass
-
-    for child in q.children:
-        if isinstance(child, Q):
-            # recurse
-            condition, child_params = render_q(child, qn, connection)
-            conditions.append(u'({})'.format(condition))
-            params.extend(child_params)
-        else:
-            try:
-                # Django 1.7
-                child, joins_used = child
-            except TypeError:
-                # Django 1.6
-                pass
-            # we expect child to be a WhereNode (see transform_q)
-            condition, child_params = child.as_sql(qn, connection)
-            params.extend(child_params)
-            conditions.append(condition)
-    rendered = u'({})'.format(joinstr.join(conditions))
-    if q.negated:
-        rendered = u'NOT {}'.format(rendered)
-    return rendered, params
+    compile_q(q)(qn, connection, out, params)
+    return u''.join(out), params
 
 
 class SQLConditionalAggregate(SQLAggregate):
@@ -85,20 +481,56 @@ class SQLConditionalAggregate(SQLAggregate):
     """
     is_ordinal = False
     is_computed = False
-    sql_template = (
-        '%(function)s('
-        'CASE WHEN %(when_clause)s THEN %(value)s ELSE %(default)s END'
-        ')'
-    )
+    sql_template = _SQL_TEMPLATE
 
     def __init__(self, col, when, source=None,
                  is_summary=False, **extra):
         self.when = when
+        self._render_when = None
+        self._field_name_cache = {}
         super(SQLConditionalAggregate, self).__init__(col, source=source,
                                                       **extra)
 
-    def get_value(self, **kwargs):
-        return kwargs['field_name']
+    def get_value(self, field_name):
+        return field_name
+
+    def _compile_render(self):
+        """
+        Compiles `self.when` once, on first render (see compile_q)
+        """
+        if self._render_when is None:
+            self._render_when = compile_q(self.when)
+        return self._render_when
+
+    def render_when(self, qn, connection, params):
+        """
+        Renders the WHEN clause, re-using a previous rendering of an
+        identical Q tree on the same db backend where possible.
+
+        Appends the query params for the clause to `params`.
+
+        :returns: SQL template str
+        """
+        q_key = getattr(self.when, '_cache_key', None)
+        if q_key is None:
+            out = []
+            self._compile_render()(qn, connection, out, params)
+            return u''.join(out)
+
+        cache_key = (q_key, connection.vendor)
+        try:
+            when_clause, when_params = _render_cache[cache_key]
+        except KeyError:
+            start = len(params)
+            out = []
+            self._compile_render()(qn, connection, out, params)
+            when_clause = u''.join(out)
+            if len(_render_cache) >= _RENDER_CACHE_SIZE:
+                _render_cache.clear()
+            _render_cache[cache_key] = (when_clause, tuple(params[start:]))
+        else:
+            params.extend(when_params)
+        return when_clause
 
     def as_sql(self, qn, connection):
         params = []
@@ -106,28 +538,43 @@ class SQLConditionalAggregate(SQLAggregate):
         if hasattr(self.col, 'as_sql'):
             field_name, params = self.col.as_sql(qn, connection)
         elif isinstance(self.col, (list, tuple)):
-            field_name = '.'.join([qn(c) for c in self.col])
+            # relabeled_clone() shallow copies us, sharing this cache, so
+            # the column needs to be part of the key
+            key = (connection.vendor, tuple(self.col))
+            field_name = self._field_name_cache.get(key)
+            if field_name is None:
+                field_name = '.'.join([qn(c) for c in self.col])
+                self._field_name_cache[key] = field_name
         else:
             field_name = self.col
 
-        when_clause, when_params = render_q(
-            q=self.when,
-            qn=qn,
-            connection=connection,
+        when_clause = self.render_when(qn, connection, params)
+
+        value = self.get_value(field_name)
+
+        # `extra` may carry substitutions of its own for custom templates
+        parts = None if self.extra else _split_template(self.sql_template)
+        if parts is None:
+            substitutions = {
+                'function': self.sql_function,
+                'when_clause': when_clause,
+                'value': value,
+                'default': self.default,
+            }
+            substitutions.update(self.extra)
+            return self.sql_template % substitutions, params
+
+        # coerce the pieces just as `%s` interpolation would
+        text = six.text_type
+        prefix, mid1, mid2, mid3, suffix = parts
+        sql = (
+            prefix + text(self.sql_function) +
+            mid1 + when_clause +
+            mid2 + text(value) +
+            mid3 + text(self.default) +
+            suffix
         )
-        params.extend(when_params)
-
-        get_val_kwargs = locals()
-        get_val_kwargs.pop('self')
-        substitutions = {
-            'function': self.sql_function,
-            'when_clause': when_clause,
-            'value': self.get_value(**get_val_kwargs),
-            'default': self.default,
-        }
-        substitutions.update(self.extra)
-
-        return self.sql_template % substitutions, params
+        return sql, params
 
 
 class ConditionalAggregate(Aggregate):
@@ -142,14 +589,39 @@ class ConditionalAggregate(Aggregate):
     """
     SQLClass = None  # define on concrete sub-class
 
+    # (model + joins + `when` key, transformed `when`, alias refcount changes)
+    _transformed_prototype = None
+
     def __init__(self, lookup, when, **extra):
         self.when = when
+        self._transformed_prototype = None
         super(ConditionalAggregate, self).__init__(lookup, **extra)
 
     def add_to_query(self, query, alias, col, source, is_summary):
-        # transform simple lookups to WhereNodes:
-        when = self.when.clone()
-        transform_q(when, query)
+        # only `when` objects on literal values can be re-used, and only
+        # while those values stay the same
+        when_key = _when_key(self.when)
+        key = (query.model, _alias_map_key(query), when_key)
+        prototype = self._transformed_prototype
+        if (when_key is not None and prototype is not None and
+                prototype[0] == key):
+            # we've already transformed `when` for an equivalent query, just
+            # take a copy and account for the joins it uses
+            _, transformed, refs = prototype
+            for join_alias, count in refs:
+                query.alias_refcount[join_alias] += count
+            when = _shallow_clone_q(transformed)
+            when._cache_key = transformed._cache_key
+        else:
+            # transform simple lookups to WhereNodes:
+            joins = _snapshot_joins(query)
+            when = _shallow_clone_q(self.when)
+            transform_q(when, query)
+            when._cache_key = _q_cache_key(when)
+            refs = _join_refs(query, joins)
+            if (when_key is not None and refs is not None and
+                    when._cache_key is not None):
+                self._transformed_prototype = (key, when, refs)
 
         aggregate = self.SQLClass(
             col=col,
@@ -222,14 +694,9 @@ class ConditionalCount(ConditionalAggregate):
         super(ConditionalAggregate, self).__init__('id', **extra)
 
     class SQLClass(SQLConditionalAggregate):
-        sql_template = (
-            '%(function)s('
-            'CASE WHEN %(when_clause)s THEN %(value)s ELSE %(default)s END'
-            ')'
-        )
         sql_function = 'COUNT'
         is_ordinal = True
         default = 'NULL'
 
-        def get_value(self, **kwargs):
+        def get_value(self, field_name):
             return '1'
@@ -1,35 +1,80 @@
-import re
+from collections import deque
+from contextlib import contextmanager
 from unittest import TestCase
 
+from django.db import connection
 from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.db.models.sql.query import Query
 from django.db.models.sql.where import WhereNode
 
 from djconnagg import ConditionalCount, ConditionalSum
-from djconnagg.aggregates import render_q, transform_q
+from djconnagg.aggregates import (
+    SQLConditionalAggregate,
+    _filter_cache,
+    _render_cache,
+    compile_q,
+    render_q,
+    transform_q,
+)
 
-from testapp.models import Customer, Stat
+from testapp.models import Customer, Deal, Stat
 
 
 def flatten_q_children(q, all_children):
     """
-    Recursively get the children of a Q object into a flat list.
+    Get the children of a Q object into a flat list, in order.
 
     (Q objects can have a nested structure when combined via parenthetical
     operations)
     """
-    for child in q.children:
+    pending = deque(q.children)
+    while pending:
+        child = pending.popleft()
         if isinstance(child, Q):
-            flatten_q_children(child, all_children)
+            pending.extendleft(reversed(child.children))
         else:
-            try:
-                # Django 1.7
-                child, joins_used = child
-            except TypeError:
-                # Django 1.6
-                pass
+            if isinstance(child, tuple):
+                # Django 1.7: (WhereNode, joins_used)
+                child = child[0]
             all_children.append(child)
 
 
+def _make_q():
+    """
+    A fresh copy of the nested Q expression used by the render tests.
+
+    (transform_q modifies its Q object in place, so tests can't share one)
+    """
+    return (
+        (Q(detail='f') | ~Q(detail='g')) |
+        Q(stat_type='u', event_type='i', detail='shu/p') & ~Q(detail='e')
+    )
+
+
+@contextmanager
+def count_calls(obj, name):
+    """
+    Temporarily wraps the `name` attribute of `obj` (a class or module) to
+    record each call made to it.
+
+    Yields the list which the call args get appended to.
+    """
+    original = vars(obj)[name]
+    wrapped = getattr(obj, name)
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        return wrapped(*args, **kwargs)
+
+    setattr(obj, name, wrapper)
+    try:
+        yield calls
+    finally:
+        setattr(obj, name, original)
+
+
 def quote_char(connection):
     """
     Returns the quote char used by db backend.
@@ -40,11 +85,12 @@ def quote_char(connection):
     return connection.ops.quote_name('')[0]
 
 
-WHITESPACE = re.compile(r'\s+|\n*', re.MULTILINE)
-
-
 def normalize_whitespace(src):
-    return WHITESPACE.sub(' ', src)
+    """
+    Strips all whitespace, so that SQL strings can be compared regardless of
+    how the different Django versions space out their clauses.
+    """
+    return ''.join(src.split())
 
 
 class AggregatesTest(TestCase):
@@ -58,12 +104,117 @@ class AggregatesTest(TestCase):
 
     maxDiff = None
 
-    def test_transform_q(self):
-        q = (
-            (Q(detail='f') | ~Q(detail='g')) |
-            Q(stat_type='u', event_type='i', detail='shu/p') & ~Q(detail='e')
+    @classmethod
+    def setUpClass(cls):
+        super(AggregatesTest, cls).setUpClass()
+        cls._base_query = Stat.objects.all().query
+        cls.qc = quote_char(connection)
+        # MySQL adds ORDER BY NULL to grouped queries
+        if 'mysql' in connection.__class__.__module__:
+            order_by = u' ORDER BY NULL'
+        else:
+            order_by = u''
+
+        cls.EXPECTED_RENDER_Q = normalize_whitespace(unicode(
+            '('
+            '{0}testapp_stat{0}.{0}detail{0} = f  OR'
+            ' (NOT ({0}testapp_stat{0}.{0}detail{0} = g ))'
+            ' OR ('
+            '({0}testapp_stat{0}.{0}stat_type{0} = u'
+            '  AND {0}testapp_stat{0}.{0}detail{0} = shu/p'
+            '  AND {0}testapp_stat{0}.{0}event_type{0} = i'
+            '  AND (NOT ({0}testapp_stat{0}.{0}detail{0} = e )))'
+            '))'
+        ).format(cls.qc))
+
+        cls.EXPECTED_RENDER_Q_SINGLE = normalize_whitespace(unicode(
+            '{0}testapp_stat{0}.{0}detail{0} = f'
+        ).format(cls.qc))
+
+        expected = unicode(
+            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
+            ' SUM(CASE WHEN'
+            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
+            '  AND {0}testapp_stat{0}.{0}event_type{0} = v'
+            ' ) THEN {0}testapp_stat{0}.{0}count{0} ELSE 0 END'
+            ') AS {0}impressions{0}'
+            ' FROM {0}testapp_stat{0}'
+            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
+        )
+        cls.EXPECTED_SUM_SQL = normalize_whitespace(
+            (expected + order_by).format(cls.qc)
+        )
+
+        expected = unicode(
+            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
+            ' COUNT(CASE WHEN'
+            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
+            '  AND {0}testapp_stat{0}.{0}event_type{0} = v'
+            ' ) THEN 1 ELSE NULL END'
+            ') AS {0}impressions{0}'
+            ' FROM {0}testapp_stat{0}'
+            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
+        )
+        cls.EXPECTED_COUNT_SQL = normalize_whitespace(
+            (expected + order_by).format(cls.qc)
+        )
+
+        expected = unicode(
+            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
+            ' SUM(CASE WHEN'
+            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
+            '  AND {0}testapp_stat{0}.{0}event_type{0} IN (v, b)'
+            ' ) THEN {0}testapp_stat{0}.{0}count{0} ELSE 0 END'
+            ') AS {0}impressions{0}'
+            ' FROM {0}testapp_stat{0}'
+            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
+        )
+        cls.EXPECTED_SUM_IN_SQL = normalize_whitespace(
+            (expected + order_by).format(cls.qc)
+        )
+
+        expected = unicode(
+            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
+            ' SUM(CASE WHEN'
+            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
+            '  AND {0}testapp_stat{0}.{0}event_type{0} = v'
+            ' ) THEN {0}testapp_stat{0}.{0}count{0} ELSE 0 END'
+            ') AS {0}impressions{0}'
+            ' FROM {0}testapp_customer{0}'
+            '  LEFT OUTER JOIN {0}testapp_stat{0}'
+            '  ON ({0}testapp_customer{0}.{0}id{0} = {0}testapp_stat{0}.{0}customer_id{0})'
+            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
+        )
+        cls.EXPECTED_SUM_RELATION_SQL = normalize_whitespace(
+            (expected + order_by).format(cls.qc)
+        )
+
+        expected = unicode(
+            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
+            ' SUM(CASE WHEN'
+            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
+            '  AND {0}testapp_stat{0}.{0}event_type{0} = v'
+            ' ) THEN {0}testapp_stat{0}.{0}count{0} ELSE 0 END'
+            ') AS {0}impressions{0}'
+            ' FROM {0}testapp_customer{0}'
+            '  LEFT OUTER JOIN {0}testapp_stat{0}'
+            '  ON ({0}testapp_customer{0}.{0}id{0} = {0}testapp_stat{0}.{0}customer_id{0})'
+            ' WHERE {0}testapp_customer{0}.{0}name{0} = Big Corp'
+            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
         )
-        query = Stat.objects.all().query
+        cls.EXPECTED_SUM_RELATION_FILTER_SQL = normalize_whitespace(
+            (expected + order_by).format(cls.qc)
+        )
+
+    def stat_qs(self):
+        """
+        A fresh Stat queryset, cloned from the query built in setUpClass
+        """
+        return QuerySet(model=Stat, query=self._base_query.clone())
+
+    def test_transform_q(self):
+        q = _make_q()
+        query = self._base_query.clone()
         transform_q(q, query)
 
         all_children = []
@@ -72,11 +223,8 @@ class AggregatesTest(TestCase):
             self.assertIsInstance(child, (Q, WhereNode))
 
     def test_render_q(self):
-        q = (
-            (Q(detail='f') | ~Q(detail='g')) |
-            Q(stat_type='u', event_type='i', detail='shu/p') & ~Q(detail='e')
-        )
-        query = Stat.objects.all().query
+        q = _make_q()
+        query = self._base_query.clone()
         transform_q(q, query)
 
         compiler = query.get_compiler('default')
@@ -89,25 +237,33 @@ class AggregatesTest(TestCase):
         )
         rendered = sql % tuple(params)
 
-        expected = unicode(
-            '('
-            '{0}testapp_stat{0}.{0}detail{0} = f  OR'
-            ' (NOT ({0}testapp_stat{0}.{0}detail{0} = g ))'
-            ' OR ('
-            '({0}testapp_stat{0}.{0}stat_type{0} = u'
-            '  AND {0}testapp_stat{0}.{0}detail{0} = shu/p'
-            '  AND {0}testapp_stat{0}.{0}event_type{0} = i'
-            '  AND (NOT ({0}testapp_stat{0}.{0}detail{0} = e )))'
-            '))'
-        ).format(quote_char(compiler.connection))
+        self.assertEqual(
+            normalize_whitespace(rendered),
+            self.EXPECTED_RENDER_Q
+        )
+
+    def test_render_q_single_child(self):
+        """
+        a lone condition doesn't need wrapping in parentheses
+        """
+        q = Q(Q(detail='f'))
+        query = self._base_query.clone()
+        transform_q(q, query)
+
+        compiler = query.get_compiler('default')
+
+        sql, params = render_q(q, compiler.quote_name_unless_alias,
+                               compiler.connection)
+        self.assertEqual(tuple(params), ('f',))
+        rendered = sql % tuple(params)
 
         self.assertEqual(
             normalize_whitespace(rendered),
-            normalize_whitespace(expected)
+            self.EXPECTED_RENDER_Q_SINGLE
         )
 
     def test_conditional_sum_as_sql(self):
-        qs = Stat.objects.values('campaign_id').annotate(
+        qs = self.stat_qs().values('campaign_id').annotate(
             impressions=ConditionalSum(
                 'count',
                 when=Q(stat_type='a', event_type='v')
@@ -122,27 +278,13 @@ class AggregatesTest(TestCase):
         )
         rendered = sql % params
 
-        expected = unicode(
-            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
-            ' SUM(CASE WHEN'
-            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
-            '  AND {0}testapp_stat{0}.{0}event_type{0} = v'
-            ' ) THEN {0}testapp_stat{0}.{0}count{0} ELSE 0 END'
-            ') AS {0}impressions{0}'
-            ' FROM {0}testapp_stat{0}'
-            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
-        )
-        if 'mysql' in compiler.connection.__class__.__module__:
-            expected += u' ORDER BY NULL'
-        expected = expected.format(quote_char(compiler.connection))
-
         self.assertEqual(
             normalize_whitespace(rendered),
-            normalize_whitespace(expected)
+            self.EXPECTED_SUM_SQL
         )
 
     def test_conditional_sum_in_clause_as_sql(self):
-        qs = Stat.objects.values('campaign_id').annotate(
+        qs = self.stat_qs().values('campaign_id').annotate(
             impressions=ConditionalSum(
                 'count',
                 when=Q(stat_type='a', event_type__in=('v', 'b'))
@@ -157,23 +299,9 @@ class AggregatesTest(TestCase):
         )
         rendered = sql % params
 
-        expected = unicode(
-            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
-            ' SUM(CASE WHEN'
-            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
-            '  AND {0}testapp_stat{0}.{0}event_type{0} IN (v, b)'
-            ' ) THEN {0}testapp_stat{0}.{0}count{0} ELSE 0 END'
-            ') AS {0}impressions{0}'
-            ' FROM {0}testapp_stat{0}'
-            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
-        )
-        if 'mysql' in compiler.connection.__class__.__module__:
-            expected += u' ORDER BY NULL'
-        expected = expected.format(quote_char(compiler.connection))
-
         self.assertEqual(
             normalize_whitespace(rendered),
-            normalize_whitespace(expected)
+            self.EXPECTED_SUM_IN_SQL
         )
 
     def test_conditional_sum_across_relation_as_sql(self):
@@ -192,25 +320,9 @@ class AggregatesTest(TestCase):
         )
         rendered = sql % params
 
-        expected = unicode(
-            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
-            ' SUM(CASE WHEN'
-            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
-            '  AND {0}testapp_stat{0}.{0}event_type{0} = v'
-            ' ) THEN {0}testapp_stat{0}.{0}count{0} ELSE 0 END'
-            ') AS {0}impressions{0}'
-            ' FROM {0}testapp_customer{0}'
-            '  LEFT OUTER JOIN {0}testapp_stat{0}'
-            '  ON ({0}testapp_customer{0}.{0}id{0} = {0}testapp_stat{0}.{0}customer_id{0})'
-            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
-        )
-        if 'mysql' in compiler.connection.__class__.__module__:
-            expected += u' ORDER BY NULL'
-        expected = expected.format(quote_char(compiler.connection))
-
         self.assertEqual(
             normalize_whitespace(rendered),
-            normalize_whitespace(expected)
+            self.EXPECTED_SUM_RELATION_SQL
         )
 
     def test_conditional_sum_across_relation_local_filter_as_sql(self):
@@ -234,30 +346,13 @@ class AggregatesTest(TestCase):
         )
         rendered = sql % params
 
-        expected = unicode(
-            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
-            ' SUM(CASE WHEN'
-            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
-            '  AND {0}testapp_stat{0}.{0}event_type{0} = v'
-            ' ) THEN {0}testapp_stat{0}.{0}count{0} ELSE 0 END'
-            ') AS {0}impressions{0}'
-            ' FROM {0}testapp_customer{0}'
-            '  LEFT OUTER JOIN {0}testapp_stat{0}'
-            '  ON ({0}testapp_customer{0}.{0}id{0} = {0}testapp_stat{0}.{0}customer_id{0})'
-            ' WHERE {0}testapp_customer{0}.{0}name{0} = Big Corp'
-            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
-        )
-        if 'mysql' in compiler.connection.__class__.__module__:
-            expected += u' ORDER BY NULL'
-        expected = expected.format(quote_char(compiler.connection))
-
         self.assertEqual(
             normalize_whitespace(rendered),
-            normalize_whitespace(expected)
+            self.EXPECTED_SUM_RELATION_FILTER_SQL
         )
 
     def test_conditional_count_as_sql(self):
-        qs = Stat.objects.values('campaign_id').annotate(
+        qs = self.stat_qs().values('campaign_id').annotate(
             impressions=ConditionalCount(
                 when=Q(stat_type='a', event_type='v')
             )
@@ -271,24 +366,28 @@ class AggregatesTest(TestCase):
         )
         rendered = sql % params
 
-        expected = unicode(
-            'SELECT {0}testapp_stat{0}.{0}campaign_id{0},'
-            ' COUNT(CASE WHEN'
-            ' ({0}testapp_stat{0}.{0}stat_type{0} = a'
-            '  AND {0}testapp_stat{0}.{0}event_type{0} = v'
-            ' ) THEN 1 ELSE NULL END'
-            ') AS {0}impressions{0}'
-            ' FROM {0}testapp_stat{0}'
-            ' GROUP BY {0}testapp_stat{0}.{0}campaign_id{0}'
-        )
-        if 'mysql' in compiler.connection.__class__.__module__:
-            expected += u' ORDER BY NULL'
-        expected = expected.format(quote_char(compiler.connection))
-
         self.assertEqual(
             normalize_whitespace(rendered),
-            normalize_whitespace(expected)
+            self.EXPECTED_COUNT_SQL
+        )
+
+    def test_non_string_value(self):
+        """
+        `get_value` may return a non-string, e.g. a number to sum
+        """
+        class ConditionalTwos(ConditionalCount):
+            class SQLClass(ConditionalCount.SQLClass):
+                sql_function = 'SUM'
+                default = 0
+
+                def get_value(self, field_name):
+                    return 2
+
+        qs = self.stat_qs().values('campaign_id').annotate(
+            impressions=ConditionalTwos(when=Q(stat_type='a'))
         )
+        sql, params = qs.query.get_compiler('default').as_sql()
+        self.assertIn(u'THEN 2 ELSE 0 END', sql)
 
     def test_reuse_aggregate(self):
         """
@@ -296,12 +395,211 @@ class AggregatesTest(TestCase):
         mutated during processing
         """
         when = Q(stat_type='a', event_type='v')
-        Stat.objects.values('campaign_id').annotate(
+        self.stat_qs().values('campaign_id').annotate(
             impressions=ConditionalSum('count', when=when)
         )
         try:
-            Stat.objects.values('campaign_id').annotate(
+            self.stat_qs().values('campaign_id').annotate(
                 impressions=ConditionalSum('count', when=when)
             )
         except Exception as e:
             self.fail("Failed to reuse `when` Q object, raised: {}".format(e))
+
+    def test_render_cache(self):
+        """
+        identical `when` trees on the same backend should share one rendering
+        of the WHEN clause
+        """
+        def compile_qs():
+            qs = self.stat_qs().values('campaign_id').annotate(
+                impressions=ConditionalSum(
+                    'count',
+                    when=Q(stat_type='a', event_type='v')
+                )
+            )
+            compiler = qs.query.get_compiler('default')
+            when = qs.query.aggregates['impressions'].when
+            return compiler, when, compiler.as_sql()
+
+        _render_cache.clear()
+        with count_calls(SQLConditionalAggregate, '_compile_render') as calls:
+            compiler, when, first = compile_qs()
+            self.assertEqual(len(calls), 1)
+            self.assertIsNotNone(when._cache_key)
+            self.assertIn(
+                (when._cache_key, compiler.connection.vendor),
+                _render_cache
+            )
+
+            _, _, second = compile_qs()
+            # served from the cache, without rendering the Q tree again
+            self.assertEqual(len(calls), 1)
+        self.assertEqual(first, second)
+
+    def test_build_filter_cache(self):
+        """
+        repeated filters on the same model should re-use the earlier
+        build_filter result and still render identical SQL
+        """
+        def compile_qs():
+            qs = Customer.objects.values('stat__campaign_id').annotate(
+                impressions=ConditionalSum(
+                    'stat__count',
+                    when=Q(stat__stat_type='a', name='Big Corp')
+                )
+            )
+            sql = qs.query.get_compiler('default').as_sql()
+            return sql, dict(qs.query.alias_refcount)
+
+        _filter_cache.clear()
+        with count_calls(Query, 'build_filter') as calls:
+            first, first_refcount = compile_qs()
+            self.assertEqual(len(calls), 2)
+
+            second, second_refcount = compile_qs()
+            # both filters came from the cache
+            self.assertEqual(len(calls), 2)
+        self.assertEqual(first, second)
+        # the replayed refcounts must match those of a real build_filter
+        self.assertEqual(first_refcount, second_refcount)
+
+    def test_compile_q(self):
+        """
+        the compiled render function can be called repeatedly and matches
+        the output of render_q
+        """
+        q = _make_q()
+        query = self._base_query.clone()
+        transform_q(q, query)
+
+        compiler = query.get_compiler('default')
+        qn = compiler.quote_name_unless_alias
+
+        render_into = compile_q(q)
+        expected = render_q(q, qn, compiler.connection)
+        for _ in range(2):
+            out = []
+            params = []
+            render_into(qn, compiler.connection, out, params)
+            self.assertEqual((u''.join(out), params), expected)
+
+    def test_reuse_transformed_when(self):
+        """
+        re-using an aggregate on an equivalent query should skip transforming
+        the `when` object again, and render the same SQL
+        """
+        impressions = ConditionalSum(
+            'count',
+            when=Q(stat_type='a', event_type='v')
+        )
+
+        def compile_qs():
+            qs = self.stat_qs().values('campaign_id').annotate(
+                impressions=impressions
+            )
+            return qs.query.get_compiler('default').as_sql()
+
+        first = compile_qs()
+        prototype = impressions._transformed_prototype
+        self.assertIsNotNone(prototype)
+
+        second = compile_qs()
+        self.assertIs(impressions._transformed_prototype, prototype)
+        self.assertEqual(first, second)
+
+    def test_reuse_when_callable_value(self):
+        """
+        Django evaluates callable filter values each time the filter is
+        built, so a re-used aggregate must not keep its first result
+        """
+        counter = iter(range(1, 10))
+        impressions = ConditionalSum(
+            'count',
+            when=Q(count__gt=lambda: next(counter))
+        )
+
+        def compile_qs():
+            qs = self.stat_qs().values('campaign_id').annotate(
+                impressions=impressions
+            )
+            return qs.query.get_compiler('default').as_sql()
+
+        params = [tuple(compile_qs()[1]) for _ in range(3)]
+        self.assertEqual(params, [(1,), (2,), (3,)])
+        self.assertIsNone(impressions._transformed_prototype)
+
+    def test_reuse_when_mutated_value(self):
+        """
+        a re-used aggregate must pick up changes to the values in its
+        `when` object
+        """
+        event_types = ['v']
+        impressions = ConditionalSum(
+            'count',
+            when=Q(event_type__in=event_types)
+        )
+
+        def compile_qs():
+            qs = self.stat_qs().values('campaign_id').annotate(
+                impressions=impressions
+            )
+            return qs.query.get_compiler('default').as_sql()
+
+        self.assertEqual(tuple(compile_qs()[1]), ('v',))
+        event_types.append('c')
+        self.assertEqual(tuple(compile_qs()[1]), ('v', 'c'))
+
+    def test_build_filter_cache_join_fields(self):
+        """
+        the same table joined via a different foreign key mustn't re-use a
+        cached filter built on the other join
+        """
+        def compile_qs(lookup):
+            qs = (
+                Deal.objects
+                .filter(**{lookup: 'Y'})
+                .values('amount')
+                .annotate(s=ConditionalSum('amount', when=Q(buyer__name='X')))
+            )
+            return qs.query.get_compiler('default').as_sql()
+
+        _filter_cache.clear()
+        _render_cache.clear()
+        cold = compile_qs('seller__name')
+
+        _filter_cache.clear()
+        _render_cache.clear()
+        compile_qs('buyer__name')
+        warm = compile_qs('seller__name')
+        self.assertEqual(warm, cold)
+
+    def test_reuse_transformed_when_join_fields(self):
+        """
+        re-using an aggregate on a query which joins the same table via a
+        different foreign key must transform `when` again
+        """
+        s = ConditionalSum('amount', when=Q(buyer__name='X'))
+
+        def compile_qs(lookup, aggregate):
+            qs = (
+                Deal.objects
+                .filter(**{lookup: 'Y'})
+                .values('amount')
+                .annotate(s=aggregate)
+            )
+            return qs.query.get_compiler('default').as_sql()
+
+        _filter_cache.clear()
+        _render_cache.clear()
+        cold = compile_qs(
+            'seller__name',
+            ConditionalSum('amount', when=Q(buyer__name='X'))
+        )
+
+        _filter_cache.clear()
+        _render_cache.clear()
+        compile_qs('buyer__name', s)
+        _filter_cache.clear()
+        _render_cache.clear()
+        warm = compile_qs('seller__name', s)
+        self.assertEqual(warm, cold)
@@ -5,6 +5,15 @@ class Customer(models.Model):
     name = models.CharField(max_length=16)
 
 
+class Deal(models.Model):
+    """
+    Joins to Customer twice, via different foreign keys
+    """
+    buyer = models.ForeignKey(Customer, related_name='purchases')
+    seller = models.ForeignKey(Customer, related_name='sales')
+    amount = models.IntegerField(default=0)
+
+
 class Stat(models.Model):
     """
     Just imagine you need some kind of advertising stats...
@@ -16,18 +25,33 @@ class Stat(models.Model):
     )
     customer = models.ForeignKey(Customer)
     stat_type = models.CharField(max_length=1, choices=TYPE_CHOICES)
-    event_type = models.CharField(max_length=2, db_index=True)
+    event_type = models.CharField(max_length=2)
     detail = models.CharField(max_length=100, db_index=True)
     campaign_id = models.IntegerField(null=True, blank=True, db_index=True)
     count = models.IntegerField(default=0)
 
+    class Meta:
+        # cover the conditions typically used in our `when` filters, and
+        # grouping by campaign on top of those
+        index_together = [
+            ['stat_type', 'event_type'],
+            ['campaign_id', 'stat_type', 'event_type'],
+        ]
+
     def __unicode__(self):
         return (
-            "Stat:"
-            " customer={customer_id},"
-            " stat_type={stat_type},"
-            " event_type={event_type},"
-            " detail={detail},"
-            " campaign_id={campaign_id},"
-            " count={count}"
-        ).format(**self.__dict__)
+            u"Stat:"
+            u" customer=%s,"
+            u" stat_type=%s,"
+            u" event_type=%s,"
+            u" detail=%s,"
+            u" campaign_id=%s,"
+            u" count=%s"
+        ) % (
+            self.customer_id,
+            self.stat_type,
+            self.event_type,
+            self.detail,
+            self.campaign_id,
+            self.count,
+        )